@@ -1,23 +1,52 @@
-import base64
 import hmac
-import io
+import os
 import os.path as op
+import re
+import shutil
+import struct
+import tempfile
+import weakref
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+from urllib.parse import quote
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pybase64
 import streamlit as st
 
 # Set the website bar icon
 st.set_page_config(page_title="Label Editor", page_icon=":pencil:")
 st.title("Label Editor")
 
-@st.cache_data
-def image_to_data_url(_zip_file: zipfile.ZipFile, image_path: str) -> str:
-    """Open an image and convert to base64 data url."""
-    # Read image content in zip file.
-    with _zip_file.open(image_path) as image_file:
-        encoded_image = base64.b64encode(image_file.read()).decode("utf-8")
+# Minimum number of images to encode in a thread pool
+MIN_PARALLEL_IMAGES = 16
+
+# Match __MACOSX and .DS_Store files
+JUNK_FILE_PATTERN = re.compile(r"__MACOSX|\.DS_Store")
+
+# Size of the fixed part of a zip local file header
+LOCAL_HEADER_SIZE = 30
+
+# Directory served by Streamlit at /app/static when static serving is enabled
+STATIC_DIR = op.join(op.dirname(op.abspath(__file__)), "static")
+
+# Types of the known label file columns
+LABEL_COLUMN_TYPES = {
+    "path": pa.string(),
+    "text": pa.large_string(),
+    # Keep float64 so downloaded values match the uploaded ones.
+    "qc_confidence": pa.float64(),
+    "qc_passed": pa.bool_(),
+}
+
+def image_to_data_url(image_bytes: bytes, image_path: str) -> str:
+    """Convert image content to base64 data url."""
+    # Encode image content.
+    encoded_image = pybase64.b64encode_as_string(image_bytes)
     # Get image path extension.
     image_extension = image_path.split(".")[-1]
     # Generate data url.
@@ -25,6 +54,183 @@ def image_to_data_url(_zip_file: zipfile.ZipFile, image_path: str) -> str:
     return data_url
 
 
+def can_read_directly(info: zipfile.ZipInfo) -> bool:
+    """Check whether a zip entry can be read without ZipFile."""
+    is_encrypted = info.flag_bits & 0x1
+    return not is_encrypted and info.compress_type in (
+        zipfile.ZIP_STORED,
+        zipfile.ZIP_DEFLATED,
+    )
+
+
+def read_entry(fd: int, info: zipfile.ZipInfo) -> bytes:
+    """Read and decompress a zip entry with positional reads."""
+    # Skip the local header, its file name and extra field.
+    header = os.pread(fd, LOCAL_HEADER_SIZE, info.header_offset)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    data_offset = info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length
+    data = os.pread(fd, info.compress_size, data_offset)
+    # Decompress raw deflate data, zlib releases the GIL.
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        data = zlib.decompress(data, -zlib.MAX_WBITS)
+    if zlib.crc32(data) != info.CRC:
+        raise zipfile.BadZipFile(f"Bad CRC-32 for file '{info.filename}'")
+    return data
+
+
+def read_images(
+    zip_file: zipfile.ZipFile, upload_path: str, infos: list[zipfile.ZipInfo]
+) -> dict[str, bytes]:
+    """Read images in the zip file, in parallel for large inputs."""
+    direct_infos = [info for info in infos if can_read_directly(info)]
+    # Read serially when the pool overhead is not worth it.
+    if not hasattr(os, "pread") or len(direct_infos) < MIN_PARALLEL_IMAGES:
+        return {info.filename: zip_file.read(info) for info in infos}
+    # Read the remaining entries through ZipFile.
+    image_blobs = {
+        info.filename: zip_file.read(info)
+        for info in infos
+        if not can_read_directly(info)
+    }
+    fd = os.open(upload_path, os.O_RDONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            contents = executor.map(partial(read_entry, fd), direct_infos)
+            for info, content in zip(direct_infos, contents):
+                image_blobs[info.filename] = content
+    finally:
+        os.close(fd)
+    return image_blobs
+
+
+def images_to_data_urls(image_blobs: dict[str, bytes], image_paths: list[str]) -> list[str]:
+    """Convert images to base64 data urls, in parallel for large inputs."""
+    image_contents = [image_blobs[image_path] for image_path in image_paths]
+    # Encode serially when the pool overhead is not worth it.
+    if len(image_paths) < MIN_PARALLEL_IMAGES:
+        return list(map(image_to_data_url, image_contents, image_paths))
+    # pybase64 releases the GIL, so threads encode concurrently.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return list(executor.map(image_to_data_url, image_contents, image_paths))
+
+
+def list_files(zip_file: zipfile.ZipFile) -> list[str]:
+    """List files in the zip file, excluding __MACOSX and .DS_Store files."""
+    is_junk = JUNK_FILE_PATTERN.search
+    return [file for file in zip_file.namelist() if not is_junk(file)]
+
+
+def upload_static_dir(upload_path: str) -> str:
+    """Get the static directory holding the images of an upload."""
+    upload_name = op.splitext(op.basename(upload_path))[0]
+    return op.join(STATIC_DIR, upload_name)
+
+
+def images_to_static_urls(
+    image_blobs: dict[str, bytes], image_paths: list[str], upload_path: str
+) -> list[str]:
+    """Write images to the static directory and return their urls."""
+    output_dir = upload_static_dir(upload_path)
+    for image_path, image_bytes in image_blobs.items():
+        output_path = op.normpath(op.join(output_dir, image_path))
+        # Refuse zip entries pointing outside of the output directory.
+        if not output_path.startswith(output_dir + os.sep):
+            raise ValueError(f"Invalid image path '{image_path}' in the zip file.")
+        os.makedirs(op.dirname(output_path), exist_ok=True)
+        with open(output_path, "wb") as f:
+            f.write(image_bytes)
+    url_prefix = f"/app/static/{op.basename(output_dir)}/"
+    return [url_prefix + quote(image_path) for image_path in image_paths]
+
+
+def remove_upload(upload_path: str, zip_file: zipfile.ZipFile) -> None:
+    """Close and remove a spooled upload and its static images."""
+    zip_file.close()
+    if op.exists(upload_path):
+        os.remove(upload_path)
+    shutil.rmtree(upload_static_dir(upload_path), ignore_errors=True)
+
+
+class SpooledUpload:
+    """Uploaded zip file copied to a temporary file on disk."""
+
+    def __init__(self, file) -> None:
+        file.seek(0)
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".zip") as tmp:
+            shutil.copyfileobj(file, tmp, length=1 << 20)
+        self.path = tmp.name
+        self.zip_file = zipfile.ZipFile(self.path)
+        self.files = list_files(self.zip_file)
+        # Clean up once the session holding the upload is gone, or at exit.
+        self._finalizer = weakref.finalize(
+            self, remove_upload, self.path, self.zip_file
+        )
+
+    def remove(self) -> None:
+        """Close and remove the spooled upload now."""
+        self._finalizer()
+
+
+def build_df(upload: SpooledUpload, label_file: str) -> pd.DataFrame:
+    """Read the label file and images in the uploaded zip file into a DataFrame."""
+    zip_file, upload_path = upload.zip_file, upload.path
+    files = list_files(zip_file)
+    files_set = set(files)
+
+    # Read label file directly from the zip file
+    sep = "\t" if label_file.endswith(".tsv") else ","
+    with zip_file.open(label_file) as f:
+        table = pa_csv.read_csv(
+            f,
+            parse_options=pa_csv.ParseOptions(delimiter=sep, quote_char=False),
+            # Read empty text as empty strings rather than nulls.
+            convert_options=pa_csv.ConvertOptions(
+                column_types=LABEL_COLUMN_TYPES, strings_can_be_null=False
+            ),
+        )
+    df = table.to_pandas(types_mapper=pd.ArrowDtype)
+
+    # Check if the file has a path and text column
+    if not {"path", "text"}.issubset(df.columns):
+        raise ValueError(
+            "The file must have 'path' and 'text' columns, but got: "
+            + ", ".join(df.columns)
+        )
+
+    # Use the common directory as root, zip paths always use "/"
+    root_dir = op.commonprefix(files).rpartition("/")[0]
+
+    # Build the image paths
+    root_prefix = root_dir + "/" if root_dir else ""
+    image_paths = (root_prefix + df["path"]).tolist()
+    # Check if the image paths exist
+    needed_paths = set(image_paths)
+    missing_paths = needed_paths.difference(files_set)
+    if missing_paths:
+        raise ValueError(
+            f"{len(missing_paths)} image paths not found in the zip file, e.g. "
+            f"'{next(iter(missing_paths))}'. This is a corrupted file."
+        )
+    # Read all needed images in a single pass over the zip file
+    image_infos = [
+        info for info in zip_file.infolist() if info.filename in needed_paths
+    ]
+    image_blobs = read_images(zip_file, upload_path, image_infos)
+
+    # Create an image url column, served statically if enabled
+    if st.get_option("server.enableStaticServing"):
+        image_urls = images_to_static_urls(image_blobs, image_paths, upload_path)
+    else:
+        image_urls = images_to_data_urls(image_blobs, image_paths)
+    df["image"] = pd.array(image_urls, dtype=pd.ArrowDtype(pa.large_string()))
+    # Create a batch column from the batch_xx/image_xx.jpg paths
+    df["_batch"] = df["path"].str.split("/", n=1).list[0].astype("category")
+    # Sort by qc_confidence within each batch if exists
+    if "qc_confidence" in df.columns:
+        df = df.sort_values(["_batch", "qc_confidence"], kind="stable")
+    return df
+
+
 def check_password():
     """Returns `True` if the user had the correct password."""
 
@@ -88,11 +294,13 @@ if not file.name.endswith(".zip"):
     st.error("Invalid file format. Please upload a ZIP file.")
     st.stop()
 
-# Unzip the file to buffer
-zip_file = zipfile.ZipFile(file)
-files = zip_file.namelist()
-# Remove all __MACOSX and .DS_Store files
-files = [file for file in files if "__MACOSX" not in file and ".DS_Store" not in file]
+# Spool the file to disk and open it once per upload
+if "upload" not in st.session_state or st.session_state["upload_key"] != file.file_id:
+    if "upload" in st.session_state:
+        st.session_state["upload"].remove()
+    st.session_state["upload"] = SpooledUpload(file)
+    st.session_state["upload_key"] = file.file_id
+files = st.session_state["upload"].files
 
 # Find the tsv file or csv file
 label_files = [file for file in files if file.endswith(".tsv") or file.endswith(".csv")]
@@ -103,71 +311,46 @@ else:
     # Use the first file
     label_file = label_files[0]
 
-if "df" not in st.session_state:
-
-    # Get the file content from the zip file
-    with zip_file.open(label_file) as f:
-        label_content = f.read()
-        label_bytes = io.BytesIO(label_content)
+# Identify the uploaded label file across reruns
+file_key = (file.file_id, label_file)
 
-    # Read label file
-    sep = "\t" if label_file.endswith(".tsv") else ","
-    df = pd.read_csv(label_bytes, sep=sep, quoting=3)
-
-    # Check if the file has a path and text column
-    if not {"path", "text"}.issubset(df.columns):
-        st.error(
-            "The file must have 'path' and 'text' columns, but got: "
-            + ", ".join(df.columns)
-        )
+# Build the DataFrame once per label file, freed with the session
+if "df" not in st.session_state or st.session_state["df_key"] != file_key:
+    try:
+        with st.spinner("Encoding images..."):
+            df = build_df(st.session_state["upload"], label_file)
+    except ValueError as e:
+        st.error(str(e))
         st.stop()
-
-    # Use commonpath as root.
-    root_dir = op.commonpath(files)
-
-    # Create a partial function to convert image to data url
-    image_to_data_url = partial(image_to_data_url, zip_file)
-
-    # Create a temporary path column
-    df["image"] = df["path"].apply(lambda x: op.join(root_dir, x))
-    # Check if the image path exists
-    for image_path in df["image"]:
-        if image_path not in files:
-            st.error(
-                f"Image path '{image_path}' not found in the zip file. This is a corrupted file."
-            )
-            st.stop()
-    # Create a base64 data url column
-    df["image"] = df["image"].apply(image_to_data_url)
-    # Fill NaN with empty string on text column
-    df["text"] = df["text"].fillna("")
-    # Cast column qc_confidence to float if exists
-    if "qc_confidence" in df.columns:
-        df["qc_confidence"] = df["qc_confidence"].astype(float)
-    # Cast column qc_passed to bool if exists
-    if "qc_passed" in df.columns:
-        df["qc_passed"] = df["qc_passed"].astype(bool)
-    # Save the DataFrame to session state
     st.session_state["df"] = df
+    st.session_state["df_key"] = file_key
 else:
     df = st.session_state["df"]
 
-# Find all batches in the df["path"] column
-# batch_xx/image_xx.jpg
-batches = df["path"].apply(lambda x: x.split("/")[0]).unique().tolist()
-batches = sorted(batches, key=lambda x: int(x.split("_")[1]))
+if "batches" not in st.session_state or st.session_state["current_file"] != file_key:
+    # Find all batches in the df["_batch"] column
+    batches = df["_batch"].unique().tolist()
+    batches = sorted(batches, key=lambda x: int(x.split("_")[1]))
+    st.session_state["batches"] = batches
+    # Find the row positions of each batch
+    st.session_state["batch_offsets"] = df.groupby(
+        "_batch", sort=False, observed=True
+    ).indices
+    st.session_state["current_file"] = file_key
+else:
+    batches = st.session_state["batches"]
 
 # Add batch_xx selection
 batch = st.selectbox("Select a batch", batches)
 
-if "batch_df" not in st.session_state or st.session_state["current_batch"] != batch:
-    # Filter the DataFrame by batch
-    batch_df = df[df["path"].str.contains(batch + "/")]
-    # Sort by qc_confidence if exists
-    if "qc_confidence" in batch_df.columns:
-        batch_df = batch_df.sort_values("qc_confidence", ascending=True)
+if (
+    "batch_df" not in st.session_state
+    or st.session_state["current_batch"] != (file_key, batch)
+):
+    # Slice the DataFrame by batch, already sorted by qc_confidence
+    batch_df = df.iloc[st.session_state["batch_offsets"][batch]]
     st.session_state["batch_df"] = batch_df
-    st.session_state["current_batch"] = batch
+    st.session_state["current_batch"] = (file_key, batch)
 else:
     batch_df = st.session_state["batch_df"]
 
@@ -209,8 +392,8 @@ edited_df = st.data_editor(
     hide_index=False,
     column_config=column_config,
 )
-# Remove the image column from the edited DataFrame
-edited_df.drop(columns=["image"], inplace=True)
+# Remove the image and batch columns from the edited DataFrame
+edited_df.drop(columns=["image", "_batch"], inplace=True)
 # Sort the DataFrame by qc_confidence if exists
 if "qc_confidence" in edited_df.columns:
     edited_df = edited_df.reset_index()
@@ -218,7 +401,7 @@ if "qc_confidence" in edited_df.columns:
 # Edited filename
 save_filename = f"{batch}_labels.tsv"
 
-# Download button
+# Download button, pyarrow's CSV writer cannot reproduce quoting=3 output
 st.download_button(
     label="Download Label",
     data=edited_df.to_csv(sep="\t", index=False, quoting=3),